@@ -1,17 +1,22 @@
-import os
 import sys
-import re
+import asyncio
 import logging
 import functools
-from typing import Optional, Dict, Any, Callable
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Set
 
+import httpx
 import uvicorn
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from fastapi import FastAPI
-from supabase import create_client, Client
+from fastapi.responses import ORJSONResponse
 from mcp.server.fastmcp import FastMCP
+from pydantic import Field, SecretStr, ValidationError
+from pydantic_settings import BaseSettings
 from starlette.requests import Request
 from starlette.responses import Response
+from starlette.routing import Route, Mount
 from mcp.server.sse import SseServerTransport
 
 # --- 1. 日志配置 ---
@@ -21,122 +26,243 @@ logging.basicConfig(
     stream=sys.stderr
 )
 
-# --- 2. 错误处理装饰器 ---
-def supabase_tool_handler(func: Callable) -> Callable:
-    """统一处理 Supabase 查询的错误和日志"""
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        logging.info(f"调用工具: {func.__name__}，参数: {kwargs}")
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            logging.error(f"查询出错: {e}", exc_info=True)
-            return f"查询失败: {str(e)}"
-    return wrapper
-
-# --- 3. 初始化 ---
+# --- 2. 初始化 ---
 load_dotenv()
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-PORT = int(os.environ.get("PORT", 8080))  # 【修复】将默认端口改回 8080
+
+class Settings(BaseSettings):
+    """从环境变量读取的配置，启动时解析并校验一次"""
+    SUPABASE_URL: str = Field(min_length=1)
+    SUPABASE_KEY: SecretStr = Field(min_length=1)
+    PORT: int = 8080  # 【修复】将默认端口改回 8080
+
+@functools.lru_cache
+def get_settings() -> Settings:
+    return Settings()
 
 # 环境变量检查
-if not SUPABASE_URL or not SUPABASE_KEY:
-    logging.error("环境变量 SUPABASE_URL 或 SUPABASE_KEY 未设置")
+try:
+    settings = get_settings()
+except ValidationError as e:
+    logging.error("环境变量 SUPABASE_URL 或 SUPABASE_KEY 未设置或无效: %s", e)
     sys.exit(1)
 
-assert isinstance(SUPABASE_URL, str), "SUPABASE_URL 必须是字符串"
-assert isinstance(SUPABASE_KEY, str), "SUPABASE_KEY 必须是字符串"
+# PostgREST 请求头与查询 URL 前缀只构建一次，每次请求只需拼接代码列表
+# 只请求数据库中存在的列
+SUPABASE_HEADERS = {
+    "apikey": settings.SUPABASE_KEY.get_secret_value(),
+    "Authorization": f"Bearer {settings.SUPABASE_KEY.get_secret_value()}"
+}
+PE_QUERY_URL = f"{settings.SUPABASE_URL.rstrip('/')}/rest/v1/stocks?select=stock_code,pe_percentile_3y&stock_code=in."
 
-# Supabase 客户端初始化
+# Supabase 客户端初始化：直接访问 REST (PostgREST) 接口，全程异步
+# 连接池复用 keep-alive 连接，避免每次查询重新握手
 try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    http_client = httpx.AsyncClient(
+        headers=SUPABASE_HEADERS,
+        limits=httpx.Limits(max_connections=15, max_keepalive_connections=5),
+        timeout=30,
+        http2=True,
+    )
     logging.info("Supabase 客户端初始化成功")
 except Exception as e:
-    logging.error(f"Supabase 初始化失败: {e}", exc_info=True)
+    logging.exception("Supabase 初始化失败: %s", e)
     sys.exit(1)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用关闭时释放连接池"""
+    yield
+    await http_client.aclose()
+
 # FastAPI & MCP 初始化
 app = FastAPI(
     title="PE分位数查询工具",
     version="1.0.0",
-    description="查询股票近三年PE历史分位数的工具"
+    description="查询股票近三年PE历史分位数的工具",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 mcp = FastMCP("PE Query Tool")
 
+@functools.lru_cache(maxsize=8192)
 def normalize_stock_code(code: str) -> Optional[str]:
     """验证股票代码格式是否符合标准 (sh600739 或 sz301011)
     
+    同时接受 Tushare 格式 (600739.SH)，并转换为标准格式。
+    返回值经 sys.intern 驻留，不同写法的同一代码共享同一个字符串对象。
+    
     Args:
         code: 输入的股票代码
         
     Returns:
-        Optional[str]: 格式正确则返回小写的代码，否则返回 None
+        Optional[str]: 格式正确则返回小写的标准代码，否则返回 None
     """
     code = code.strip().lower()
-    if re.match(r'^(sh|sz)\d{6}$', code):
-        return code
+    if len(code) == 8 and code[:2] in ('sh', 'sz') and code[2:].isascii() and code[2:].isdigit():
+        return sys.intern(code)
+    if len(code) == 9 and code[6] == '.' and code[:6].isascii() and code[:6].isdigit() and code[7:] in ('sh', 'sz'):
+        return sys.intern(code[7:] + code[:6])
     return None
 
+# PE 分位数据每日最多更新一次，按标准化代码缓存查询结果（含"未找到"）
+_pe_cache: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+_pe_cache_stats: Dict[str, int] = {"hit": 0, "miss": 0}
+_CACHE_MISS = object()
+
+# 渲染后的返回文本缓存，按原始输入缓存（返回文本中包含原始输入的代码）
+_response_cache: TTLCache = TTLCache(maxsize=4096, ttl=900)
+
+async def _query_pe_batch(codes: List[str]) -> Dict[str, Dict[str, Any]]:
+    """用一次 stock_code=in.(...) 请求查询多只股票
+    
+    Args:
+        codes: 标准化后的股票代码列表
+        
+    Returns:
+        Dict[str, Dict[str, Any]]: 以 stock_code 为键的行，不存在的代码不在其中
+    """
+    logging.info("批量查询 %d 只股票: %s", len(codes), codes)
+    response = await http_client.get(f"{PE_QUERY_URL}({','.join(codes)})")
+    response.raise_for_status()
+    return {row['stock_code']: row for row in response.json()}
+
+class _PEBatchLoader:
+    """DataLoader 式合并查询：在短时间窗口内收集代码，合并为一次批量请求"""
+
+    def __init__(self, max_batch_size: int = 100, delay: float = 0.01):
+        self._max_batch_size = max_batch_size
+        self._delay = delay
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()  # 持有引用，防止任务被回收
+
+    def load(self, normalized_code: str) -> asyncio.Future:
+        """登记一个待查询代码，返回在批量请求完成后得到结果的 Future"""
+        if (future := self._pending.get(normalized_code)) is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = self._pending[normalized_code] = loop.create_future()
+        if len(self._pending) >= self._max_batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._delay, self._dispatch)
+        return future
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[str, asyncio.Future]) -> None:
+        try:
+            rows = await _query_pe_batch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for code, future in batch.items():
+            if not future.done():
+                future.set_result(rows.get(code))
+
+_pe_loader = _PEBatchLoader()
+
+async def _fetch_pe(normalized_code: str, no_cache: bool = False) -> Optional[Dict[str, Any]]:
+    """查询单只股票的 PE 数据，命中缓存时跳过 Supabase 请求
+    
+    Args:
+        normalized_code: 经 normalize_stock_code 处理后的代码
+        no_cache: 为 True 时跳过缓存查询，并用最新结果刷新缓存
+        
+    Returns:
+        Optional[Dict[str, Any]]: 数据库中的行，不存在则返回 None
+    """
+    stock_data = _CACHE_MISS if no_cache else _pe_cache.get(normalized_code, _CACHE_MISS)
+    if stock_data is not _CACHE_MISS:
+        _pe_cache_stats["hit"] += 1
+        logging.info("PE 缓存命中: %s (hit=%d, miss=%d)", normalized_code, _pe_cache_stats["hit"], _pe_cache_stats["miss"])
+        return stock_data
+
+    _pe_cache_stats["miss"] += 1
+    logging.info("PE 缓存未命中: %s (hit=%d, miss=%d)", normalized_code, _pe_cache_stats["hit"], _pe_cache_stats["miss"])
+    
+    # shield: 同一 Future 可能被多个调用方共享，单个调用方取消不应影响其他调用方
+    stock_data = await asyncio.shield(_pe_loader.load(normalized_code))
+    _pe_cache[normalized_code] = stock_data
+    return stock_data
+
 @mcp.tool()
-@supabase_tool_handler
-def get_pe_percentile(stock_code: str) -> str:
+async def get_pe_percentile(stock_code: str, no_cache: bool = False) -> str:
     """查询股票PE分位数
     
     Args:
-        stock_code: 股票代码，如 'sh600739' 或 'sz301011'
+        stock_code: 股票代码，如 'sh600739' 或 'sz301011'，也支持 Tushare 格式 '600739.SH'
+        no_cache: 为 True 时跳过缓存，直接查询最新数据
     """
+    logging.info("查询股票: %s", stock_code)
     if not (normalized_code := normalize_stock_code(stock_code)):
         return f"股票代码格式错误：'{stock_code}'。请使用标准格式，如：sh600739 或 sz301011"
     
-    # 只请求数据库中存在的列
-    response = supabase.table('stocks') \
-        .select('stock_code, pe_percentile_3y') \
-        .eq('stock_code', normalized_code) \
-        .execute()
+    if not no_cache and (result := _response_cache.get(stock_code)) is not None:
+        return result
     
-    if not response.data:
-        return f"未找到股票：{stock_code}"  # 使用原始输入的代码
-        
-    stock_data = response.data[0]
-    pe_value = stock_data.get('pe_percentile_3y')
+    try:
+        if not (stock_data := await _fetch_pe(normalized_code, no_cache)):
+            result = f"未找到股票：{stock_code}"  # 使用原始输入的代码
+        elif (pe_value := stock_data.get('pe_percentile_3y')) is None:
+            result = f"股票 {stock_code} 暂无PE分位数据"
+        else:
+            result = f"股票 {stock_code} 的近三年PE分位：{pe_value:.4f}"
+    except Exception as e:
+        logging.exception("查询出错: %s", e)
+        return f"查询失败: {str(e)}"
     
-    if pe_value is None:
-        return f"股票 {stock_code} 暂无PE分位数据"
-        
-    return f"股票 {stock_code} 的近三年PE分位：{pe_value:.4f}"
+    _response_cache[stock_code] = result
+    return result
+
+# 健康检查被探针频繁调用，响应体预先编码，跳过每次的 JSON 序列化
+_HEALTH_BODY = b'{"status":"healthy"}'
 
 @app.get("/")
-async def health_check() -> Dict[str, str]:
+async def health_check() -> Response:
     """健康检查端点"""
-    return {"status": "healthy"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 # --- MCP SSE 集成 (参考 demo.py 的最终修正版) ---
 MCP_BASE_PATH = "/sse"  # 修改为 /sse
+messages_full_path = f"{MCP_BASE_PATH}/messages/"
 try:
-    messages_full_path = f"{MCP_BASE_PATH}/messages/"
     sse_transport = SseServerTransport(messages_full_path)
+except Exception as e:
+    logging.critical("应用 MCP SSE 设置时发生严重错误: %s", e, exc_info=True)
+    sys.exit(1)
 
-    async def handle_mcp_sse_handshake(request: Request) -> None:
-        """
-        处理 MCP 的 SSE 握手。
-        此函数不返回任何值，因为 sse_transport 会完全接管响应流。
-        """
-        async with sse_transport.connect_sse(
-            request.scope, 
-            request.receive, 
-            request._send
-        ) as (read_stream, write_stream):
-            await mcp._mcp_server.run(
-                read_stream, 
-                write_stream, 
-                mcp._mcp_server.create_initialization_options()
-            )
-
-    @mcp.prompt()
-    def usage_guide() -> str:
-        """提供使用指南"""
-        return """欢迎使用 PE 分位数查询工具！
+async def handle_mcp_sse_handshake(request: Request) -> None:
+    """
+    处理 MCP 的 SSE 握手。
+    此函数不返回任何值，因为 sse_transport 会完全接管响应流。
+    """
+    async with sse_transport.connect_sse(
+        request.scope, 
+        request.receive, 
+        request._send
+    ) as (read_stream, write_stream):
+        await mcp._mcp_server.run(
+            read_stream, 
+            write_stream, 
+            mcp_init_options
+        )
+
+@mcp.prompt()
+def usage_guide() -> str:
+    """提供使用指南"""
+    return """欢迎使用 PE 分位数查询工具！
 
 股票代码格式说明：
 - 上海证券交易所：sh + 6位数字，如 sh600739
@@ -147,16 +273,17 @@ try:
 > get_pe_percentile("sz301011")  # 华立新材
 """
 
-    # 注册路由
-    app.add_route(MCP_BASE_PATH, handle_mcp_sse_handshake, methods=["GET"])  # type: ignore
-    app.mount(messages_full_path, sse_transport.handle_post_message)
-    
-    logging.info("MCP SSE 集成设置完成")
+# 初始化选项在所有工具和提示注册完成后构建一次，所有 SSE 连接共用
+mcp_init_options = mcp._mcp_server.create_initialization_options()
 
-except Exception as e:
-    logging.critical(f"应用 MCP SSE 设置时发生严重错误: {e}", exc_info=True)
-    sys.exit(1)
+# 注册路由：导入时一次性加入路由表
+app.router.routes.extend([
+    Route(MCP_BASE_PATH, handle_mcp_sse_handshake, methods=["GET"]),
+    Mount(messages_full_path, app=sse_transport.handle_post_message),
+])
+
+logging.info("MCP SSE 集成设置完成")
 
 if __name__ == "__main__":
-    logging.info(f"启动服务器，监听端口: {PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    logging.info("启动服务器，监听端口: %s", settings.PORT)
+    uvicorn.run(app, host="0.0.0.0", port=settings.PORT, loop="uvloop", http="httptools")
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- stock_code 是唯一的查询条件 (eq. / in.)，加唯一索引避免全表扫描
+CREATE UNIQUE INDEX IF NOT EXISTS stocks_stock_code_idx ON stocks (stock_code);